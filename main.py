@@ -4,51 +4,130 @@ Handles all bot commands, conversation flows, and AI-mediated interactions.
 """
 
 import os
+import asyncio
 import logging
-import json
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import orjson
+from cachetools import TTLCache
+import redis.asyncio as redis
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, 
-    ConversationHandler, CallbackQueryHandler, ContextTypes
+    ConversationHandler, CallbackQueryHandler, ContextTypes, BaseUpdateProcessor
 )
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # uvloop is optional and not available on Windows
+    uvloop = None
+
+# Use the faster uvloop event loop where it is available. It is created and
+# set here, before any asyncio object exists: on Python 3.8/3.9 the Redis
+# pool and PTB's queues bind to the current loop when they are constructed,
+# and run_polling/run_webhook pick up this loop through get_event_loop().
+if uvloop is not None:
+    asyncio.set_event_loop(uvloop.new_event_loop())
+
 # Load environment variables
 load_dotenv()
 
+# Bot configuration, read once at import
+BOT_TOKEN = os.environ.get('BOT_TOKEN')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+PORT = int(os.environ.get('PORT', 8443))
+
 # Enable logging
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO, force=True
 )
 logger = logging.getLogger(__name__)
 
 # Database connection
 class Database:
+    # Timestamps (created_at, last_active, scheduled_time) are stored as
+    # integer nanoseconds from time.time_ns() and only formatted for display
+    
+    # Rendered /grupos and /atividades payloads
+    GROUPS_CACHE_KEY = "cache:groups:list"
+    ACTIVITIES_CACHE_KEY = "cache:activities:{}"
+    CACHE_TTL = 30  # seconds
+    
+    # group_id -> creator name, so listings don't resolve each creator
+    GROUP_CREATOR_NAME_KEY = "idx:group_creator_name"
+    
+    # In-process cache of user records, keyed by user ID
+    USER_CACHE_TTL = 60  # seconds
+    USER_CACHE_SIZE = 10000
+    
+    # How long to wait for a free pooled connection before giving up
+    POOL_TIMEOUT = 5  # seconds
+    
+    # Write-behind buffer for last_active timestamps
+    LAST_ACTIVE_FLUSH_INTERVAL = 5  # seconds
+    LAST_ACTIVE_FLUSH_SIZE = 1000
+
     def __init__(self):
         """Initialize database connection using environment variables."""
-        # This is a placeholder for MongoDB connection
-        # In a real implementation, this would connect to MongoDB
-        self.users = {}
-        self.groups = {}
-        self.activities = {}
-        self.messages = []
-        
-    def create_user(self, user_id, name, role, **kwargs):
+        redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+        max_connections = int(os.environ.get('REDIS_MAX_CONNECTIONS', 64))
+        # redis-py parses replies with hiredis (C) whenever it is installed.
+        # When every connection is checked out, callers wait for one to be
+        # released instead of failing with "Too many connections".
+        pool = redis.BlockingConnectionPool.from_url(
+            redis_url,
+            max_connections=max_connections,
+            timeout=self.POOL_TIMEOUT,
+            decode_responses=True
+        )
+        self.redis = redis.Redis.from_pool(pool)
+        self._user_cache = TTLCache(maxsize=self.USER_CACHE_SIZE, ttl=self.USER_CACHE_TTL)
+        self._last_active_buffer = {}  # user_id -> time_ns, pending flush
+
+    @staticmethod
+    def _encode(data):
+        """Flatten a record into a Redis hash mapping."""
+        return {key: orjson.dumps(value) for key, value in data.items()}
+
+    @staticmethod
+    def _decode(data):
+        """Rebuild a record from a Redis hash mapping (None if the hash is empty)."""
+        if not data:
+            return None
+        return {key: orjson.loads(value) for key, value in data.items()}
+
+    async def get_cache(self, key):
+        """Get a cached payload, or None if it is missing or expired."""
+        cached = await self.redis.get(key)
+        return orjson.loads(cached) if cached else None
+    
+    async def set_cache(self, key, payload, ttl=CACHE_TTL):
+        """Cache a JSON-serializable payload for ttl seconds."""
+        await self.redis.setex(key, ttl, orjson.dumps(payload))
+    
+    async def create_user(self, user_id, name, role, **kwargs):
         """Create a new user in the database."""
         try:
             # Base user data
+            now = time.time_ns()
             user_data = {
                 "user_id": user_id,
                 "name": name,
                 "role": role,
-                "groups": [],
-                "created_at": datetime.now(),
-                "last_active": datetime.now()
+                "created_at": now,
+                "last_active": now
             }
             
             # Add expanded profile information if provided
+            profile = None
             if role == 'autista':
                 # Default values for autistic user profile
                 profile = {
@@ -67,96 +146,188 @@ class Database:
                     }),
                     "interaction_history": []
                 }
-                user_data["profile"] = profile
             
-            # Store user
-            self.users[user_id] = user_data
+            # Groups created under a previous registration show the creator's name
+            created_groups = await self.redis.smembers(f"user:{user_id}:created_groups")
+            
+            # Store user, replacing any previous record. The profile is kept in
+            # its own key so hot paths only move the small base record.
+            pipe = self.redis.pipeline()
+            pipe.delete(f"user:{user_id}", f"user:{user_id}:profile")
+            pipe.hset(f"user:{user_id}", mapping=self._encode(user_data))
+            if profile is not None:
+                pipe.set(f"user:{user_id}:profile", orjson.dumps(profile))
+            if created_groups:
+                pipe.hset(self.GROUP_CREATOR_NAME_KEY, mapping=dict.fromkeys(created_groups, name))
+            pipe.delete(self.GROUPS_CACHE_KEY)  # AT names appear in the listing
+            await pipe.execute()
+            self._user_cache.pop(user_id, None)
             return True
         except Exception as e:
             logger.error(f"Error creating user: {e}")
             return False
     
-    def update_user_profile(self, user_id, profile_data):
+    async def update_user_profile(self, user_id, profile_data):
         """Update user profile information."""
         try:
-            if user_id not in self.users:
+            if not await self.redis.exists(f"user:{user_id}"):
                 return False
                 
             # Update profile fields
-            if "profile" not in self.users[user_id]:
-                self.users[user_id]["profile"] = {}
-                
-            for key, value in profile_data.items():
-                self.users[user_id]["profile"][key] = value
+            profile = await self.get_user_profile(user_id) or {}
+            profile.update(profile_data)
+            await self.redis.set(f"user:{user_id}:profile", orjson.dumps(profile))
                 
             return True
         except Exception as e:
             logger.error(f"Error updating user profile: {e}")
             return False
     
-    def get_user(self, user_id):
+    async def get_user(self, user_id):
         """Get user information from database."""
-        return self.users.get(user_id)
-    
-    def create_group(self, group_id, name, theme, description, created_by, max_members=10):
+        user = self._user_cache.get(user_id)
+        if user is None:
+            user = self._decode(await self.redis.hgetall(f"user:{user_id}"))
+            if user is not None:
+                self._user_cache[user_id] = user
+        return user
+    
+    async def get_user_profile(self, user_id):
+        """Get a user's expanded profile, or None if they have none."""
+        profile = await self.redis.get(f"user:{user_id}:profile")
+        return orjson.loads(profile) if profile else None
+    
+    async def next_group_id(self):
+        """Allocate a new, unique group ID."""
+        return await self.redis.incr("seq:group")
+    
+    async def create_group(self, group_id, name, theme, description, created_by, max_members=10):
         """Create a new thematic group."""
         try:
+            now = time.time_ns()
             group_data = {
                 "group_id": group_id,
                 "name": name,
                 "theme": theme,
                 "description": description,
                 "created_by": created_by,
-                "members": [created_by],  # Creator is first member
                 "max_members": max_members,
-                "created_at": datetime.now(),
-                "last_active": datetime.now(),
+                "created_at": now,
+                "last_active": now,
                 "ai_mediator_enabled": True  # Enable AI mediator by default
             }
             
-            # Store group
-            self.groups[group_id] = group_data
+            creator = await self.get_user(created_by)
             
-            # Add group to creator's groups
-            if created_by in self.users:
-                self.users[created_by]["groups"].append(group_id)
+            # Store group; the creator is its first member
+            pipe = self.redis.pipeline()
+            pipe.hset(f"group:{group_id}", mapping=self._encode(group_data))
+            if creator:
+                pipe.hset(self.GROUP_CREATOR_NAME_KEY, group_id, creator["name"])
+            pipe.sadd("groups:all", group_id)
+            if max_members > 1:
+                pipe.sadd("groups:joinable", group_id)
+            pipe.sadd(f"group:{group_id}:members", created_by)
+            pipe.sadd(f"user:{created_by}:groups", group_id)
+            pipe.sadd(f"user:{created_by}:created_groups", group_id)
+            pipe.delete(self.GROUPS_CACHE_KEY, self.ACTIVITIES_CACHE_KEY.format(created_by))
+            await pipe.execute()
             
             return True
         except Exception as e:
             logger.error(f"Error creating group: {e}")
             return False
     
-    def get_all_groups(self):
-        """Get all available groups."""
-        return list(self.groups.values())
-    
-    def get_group(self, group_id):
+    async def get_groups_by_creator(self, user_id):
+        """Get the groups a user created, oldest first."""
+        group_ids = sorted(await self.redis.smembers(f"user:{user_id}:created_groups"), key=int)
+        groups = await self.get_groups(group_ids)
+        return [groups[group_id] for group_id in group_ids if groups[group_id]]
+    
+    async def get_group_creator_names(self):
+        """Get the creator name of every group, keyed by group ID."""
+        return await self.redis.hgetall(self.GROUP_CREATOR_NAME_KEY)
+    
+    async def get_all_groups(self):
+        """Get all available groups, oldest first, each with its current members_count."""
+        group_ids = sorted(await self.redis.smembers("groups:all"), key=int)
+        pipe = self.redis.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.hgetall(f"group:{group_id}")
+            pipe.scard(f"group:{group_id}:members")
+        results = await pipe.execute()
+        
+        groups = []
+        for data, members_count in zip(results[::2], results[1::2]):
+            group = self._decode(data)
+            if group:
+                group["members_count"] = members_count
+                groups.append(group)
+        return groups
+    
+    async def get_joinable_group_ids(self):
+        """Get the IDs of the groups that still have room for new members."""
+        return await self.redis.smembers("groups:joinable")
+    
+    async def get_group(self, group_id):
         """Get group information."""
-        return self.groups.get(group_id)
-    
-    def add_user_to_group(self, user_id, group_id):
-        """Add a user to a group."""
+        return self._decode(await self.redis.hgetall(f"group:{group_id}"))
+    
+    async def get_groups(self, group_ids):
+        """Get several groups in a single round trip, keyed by group ID."""
+        group_ids = list(group_ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.hgetall(f"group:{group_id}")
+        return dict(zip(group_ids, map(self._decode, await pipe.execute())))
+    
+    async def add_user_to_group(self, user_id, group_id):
+        """Add a user to a group, unless the group is full."""
+        group_key = f"group:{group_id}"
+        members_key = f"group:{group_id}:members"
         try:
-            if group_id not in self.groups or user_id not in self.users:
-                return False
-                
-            # Add user to group's members
-            if user_id not in self.groups[group_id]["members"]:
-                self.groups[group_id]["members"].append(user_id)
-            
-            # Add group to user's groups
-            if group_id not in self.users[user_id]["groups"]:
-                self.users[user_id]["groups"].append(group_id)
+            async with self.redis.pipeline() as pipe:
+                while True:
+                    try:
+                        # Retry if another join changes the group while we decide
+                        await pipe.watch(group_key, members_key, "groups:joinable")
+                        if await pipe.exists(group_key, f"user:{user_id}") < 2:
+                            return False
+                        if await pipe.sismember(members_key, user_id):
+                            return True
+                        if not await pipe.sismember("groups:joinable", group_id):
+                            return False
+                        max_members = orjson.loads(await pipe.hget(group_key, "max_members"))
+                        members_count = await pipe.scard(members_key)
+                        if members_count >= max_members:
+                            return False
+                        
+                        # Add user to group's members and group to user's groups,
+                        # and stop offering the group once it is full
+                        pipe.multi()
+                        pipe.sadd(members_key, user_id)
+                        pipe.sadd(f"user:{user_id}:groups", group_id)
+                        if members_count + 1 >= max_members:
+                            pipe.srem("groups:joinable", group_id)
+                        pipe.delete(self.GROUPS_CACHE_KEY, self.ACTIVITIES_CACHE_KEY.format(user_id))
+                        await pipe.execute()
+                        break
+                    except redis.WatchError:
+                        continue
+            self._user_cache.pop(user_id, None)
             
             return True
         except Exception as e:
             logger.error(f"Error adding user to group: {e}")
             return False
     
-    def create_activity(self, group_id, activity_type, title, description, created_by, scheduled_time=None, duration=60):
+    async def create_activity(self, group_id, activity_type, title, description, created_by, scheduled_time=None, duration=60):
         """Create a new activity for a group."""
         try:
-            activity_id = str(datetime.now().timestamp())
+            activity_id = await self.redis.incr("seq:activity")
+            now = time.time_ns()
+            if scheduled_time is not None:
+                scheduled_time = int(scheduled_time.timestamp() * 1e9)
             
             activity_data = {
                 "activity_id": activity_id,
@@ -167,48 +338,134 @@ class Database:
                 "created_by": created_by,
                 "participants": [],
                 "status": "scheduled",
-                "scheduled_time": scheduled_time or datetime.now(),
+                "scheduled_time": scheduled_time or now,
+                "scheduled_time_str": format_timestamp(scheduled_time or now),
                 "duration": duration,
-                "created_at": datetime.now(),
+                "created_at": now,
                 "ai_guidance_enabled": True  # Enable AI guidance by default
             }
             
-            # Store activity
-            self.activities[activity_id] = activity_data
+            # Store activity and index it under its group by scheduled time
+            members = await self.redis.smembers(f"group:{group_id}:members")
+            
+            pipe = self.redis.pipeline()
+            pipe.hset(f"activity:{activity_id}", mapping=self._encode(activity_data))
+            pipe.zadd(
+                f"group:{group_id}:scheduled_activities",
+                {activity_id: activity_data["scheduled_time"] / 1e9}
+            )
+            if members:
+                pipe.delete(*(self.ACTIVITIES_CACHE_KEY.format(member) for member in members))
+            await pipe.execute()
             
             return activity_id
         except Exception as e:
             logger.error(f"Error creating activity: {e}")
             return None
     
-    def get_user_activities(self, user_id):
-        """Get activities for groups that a user is part of."""
+    async def get_user_activities(self, user_id):
+        """Get scheduled activities for groups that a user is part of, soonest first."""
         try:
-            if user_id not in self.users:
+            group_ids = await self.redis.smembers(f"user:{user_id}:groups")
+            if not group_ids:
                 return []
-                
-            user_groups = self.users[user_id]["groups"]
-            activities = []
             
-            for activity_id, activity in self.activities.items():
-                if activity["group_id"] in user_groups and activity["status"] == "scheduled":
-                    activities.append(activity)
+            pipe = self.redis.pipeline(transaction=False)
+            for group_id in group_ids:
+                pipe.zrange(f"group:{group_id}:scheduled_activities", 0, -1, withscores=True)
+            scheduled = sorted(
+                (entry for entries in await pipe.execute() for entry in entries),
+                key=lambda entry: entry[1]
+            )
+            
+            for activity_id, _ in scheduled:
+                pipe.hgetall(f"activity:{activity_id}")
             
-            return activities
+            return [activity for activity in map(self._decode, await pipe.execute()) if activity]
         except Exception as e:
             logger.error(f"Error getting user activities: {e}")
             return []
     
-    def update_last_active(self, user_id):
-        """Update user's last active timestamp."""
-        if user_id in self.users:
-            self.users[user_id]["last_active"] = datetime.now()
+    async def update_last_active(self, user_id):
+        """Update user's last active timestamp (persisted by the next flush)."""
+        now = time.time_ns()
+        self._last_active_buffer[user_id] = now
+        
+        # Keep the cached record current so the get_user that follows still hits
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            user["last_active"] = now
+        
+        if len(self._last_active_buffer) >= self.LAST_ACTIVE_FLUSH_SIZE:
+            await self.flush_last_active()
+    
+    async def flush_last_active(self):
+        """Write buffered last_active timestamps of registered users to Redis."""
+        buffer, self._last_active_buffer = self._last_active_buffer, {}
+        if not buffer:
+            return
+        
+        flushed = False
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in buffer:
+                pipe.exists(f"user:{user_id}")
+            registered = await pipe.execute()
+            
+            for (user_id, timestamp), exists in zip(buffer.items(), registered):
+                if exists:
+                    pipe.hset(f"user:{user_id}", "last_active", orjson.dumps(timestamp))
+            await pipe.execute()
+            flushed = True
+        except Exception as e:
+            logger.error(f"Error flushing last active timestamps: {e}")
+        finally:
+            # On errors and cancellation, keep the pending timestamps for the
+            # next flush unless newer ones arrived
+            if not flushed:
+                for user_id, timestamp in buffer.items():
+                    self._last_active_buffer.setdefault(user_id, timestamp)
+    
+    async def close(self):
+        """Persist buffered state and close the Redis connection pool."""
+        await self.flush_last_active()
+        await self.redis.aclose()
+    
+    async def run_last_active_flusher(self):
+        """Periodically flush buffered last_active timestamps."""
+        while True:
+            await asyncio.sleep(self.LAST_ACTIVE_FLUSH_INTERVAL)
+            await self.flush_last_active()
 
 # LLM Integration
 class LLMIntegration:
+    # Placeholder responses used until the LLM API is integrated
+    GROUP_RESPONSES = (
+        "Que discussão interessante! Alguém mais gostaria de compartilhar sua experiência?",
+        "Obrigado por compartilhar. Isso me faz pensar em como diferentes perspectivas enriquecem nossa conversa.",
+        "Vamos explorar esse tópico um pouco mais. Alguém tem alguma pergunta sobre o que foi compartilhado?",
+        "Esse é um ponto muito interessante! Como isso se relaciona com suas experiências pessoais?",
+        "Parece que temos opiniões diversas aqui. Isso é ótimo para ampliar nossa compreensão do assunto."
+    )
+    INDIVIDUAL_RESPONSES = (
+        "Entendo como você está se sentindo. Quer conversar mais sobre isso?",
+        "Obrigado por compartilhar. É normal sentir-se assim às vezes. Como posso ajudar?",
+        "Estou aqui para ouvir. Quer me contar mais sobre o que está acontecendo?",
+        "Isso parece desafiador. Vamos pensar juntos em algumas estratégias que possam ajudar.",
+        "Sua experiência é válida e importante. Como você tem lidado com isso até agora?"
+    )
+    
+    # Upper bound on LLM calls running at the same time
+    MAX_CONCURRENT_REQUESTS = 16
+
     def __init__(self):
         """Initialize LLM integration."""
         self.api_key = os.environ.get('LLM_API_KEY')
+        self._rng = random.Random()
+        # LLM API calls block, so they run here instead of on the event loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.MAX_CONCURRENT_REQUESTS, thread_name_prefix="llm"
+        )
         
     def mediate_group_conversation(self, group_id, recent_messages, current_user_id):
         """Generate AI mediator response for group conversation."""
@@ -216,16 +473,7 @@ class LLMIntegration:
         # In a real implementation, this would call the LLM API
         
         # For MVP, return a simple response
-        responses = [
-            "Que discussão interessante! Alguém mais gostaria de compartilhar sua experiência?",
-            "Obrigado por compartilhar. Isso me faz pensar em como diferentes perspectivas enriquecem nossa conversa.",
-            "Vamos explorar esse tópico um pouco mais. Alguém tem alguma pergunta sobre o que foi compartilhado?",
-            "Esse é um ponto muito interessante! Como isso se relaciona com suas experiências pessoais?",
-            "Parece que temos opiniões diversas aqui. Isso é ótimo para ampliar nossa compreensão do assunto."
-        ]
-        
-        import random
-        return random.choice(responses), False
+        return self._rng.choice(self.GROUP_RESPONSES), False
     
     def provide_individual_support(self, user_id, message_text):
         """Generate AI support response for individual conversation."""
@@ -233,20 +481,178 @@ class LLMIntegration:
         # In a real implementation, this would call the LLM API
         
         # For MVP, return a simple response
-        responses = [
-            "Entendo como você está se sentindo. Quer conversar mais sobre isso?",
-            "Obrigado por compartilhar. É normal sentir-se assim às vezes. Como posso ajudar?",
-            "Estou aqui para ouvir. Quer me contar mais sobre o que está acontecendo?",
-            "Isso parece desafiador. Vamos pensar juntos em algumas estratégias que possam ajudar.",
-            "Sua experiência é válida e importante. Como você tem lidado com isso até agora?"
-        ]
+        return self._rng.choice(self.INDIVIDUAL_RESPONSES), False
+    
+    async def provide_individual_support_async(self, user_id, message_text):
+        """Run provide_individual_support on the worker pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self.provide_individual_support, user_id, message_text
+        )
+    
+    def close(self):
+        """Stop the worker pool, letting in-flight calls finish in the background."""
+        self._executor.shutdown(wait=False)
+
+# Outbound message queue
+class MessageSender:
+    # Telegram lets a bot send about 30 messages per second across all chats
+    MESSAGES_PER_SECOND = 30
+    # Handlers wait to enqueue once this many messages are pending
+    MAX_PENDING_MESSAGES = 1000
+    # How long to keep delivering pending messages when stopping
+    DRAIN_TIMEOUT = 5
+
+    def __init__(self):
+        """Initialize the message sender."""
+        self._bot = None
+        self._chats = {}  # chat_id -> deque of pending messages, while its worker runs
+        self._workers = set()
+        self._pending = None
+        self._bucket_lock = None
+        self._tokens = 0
+        self._refilled_at = 0
+
+    def start(self, bot):
+        """Start delivering queued messages through the given bot."""
+        self._bot = bot
+        self._pending = asyncio.Semaphore(self.MAX_PENDING_MESSAGES)
+        self._bucket_lock = asyncio.Lock()
+        self._tokens = self.MESSAGES_PER_SECOND
+        self._refilled_at = asyncio.get_running_loop().time()
+
+    async def send(self, chat_id, text, **kwargs):
+        """Queue a message for delivery; each chat receives its messages in order."""
+        await self._pending.acquire()
+        message = {"chat_id": chat_id, "text": text, **kwargs}
+        queue = self._chats.get(chat_id)
+        if queue is not None:
+            queue.append(message)
+            return
+        
+        # Chats are delivered independently, so flood control on one never delays another
+        self._chats[chat_id] = deque([message])
+        worker = asyncio.create_task(self._run_chat(chat_id))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    async def reply(self, update, text, **kwargs):
+        """Queue a reply to an update's message, in its forum topic and quoting it in groups."""
+        # Mirrors what Message.reply_text adds on top of send_message
+        message = update.effective_message
+        if message.is_topic_message:
+            kwargs.setdefault("message_thread_id", message.message_thread_id)
+        if message.chat.type != 'private':
+            kwargs.setdefault("reply_to_message_id", message.message_id)
+            kwargs.setdefault("allow_sending_without_reply", True)
+        await self.send(message.chat_id, text, **kwargs)
+
+    async def _take_token(self):
+        """Wait for the bot-wide token bucket to allow one more message."""
+        async with self._bucket_lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                self._tokens = min(
+                    self.MESSAGES_PER_SECOND,
+                    self._tokens + (now - self._refilled_at) * self.MESSAGES_PER_SECOND
+                )
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.MESSAGES_PER_SECOND)
+
+    async def _deliver(self, message):
+        """Send one message, waiting out Telegram's flood control for its chat if needed."""
+        while True:
+            await self._take_token()
+            try:
+                await self._bot.send_message(**message)
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(
+                    f"Flood control exceeded for chat {message['chat_id']}, "
+                    f"retrying in {retry_after} seconds"
+                )
+                await asyncio.sleep(retry_after)
+            except Exception as e:
+                logger.error(f"Error sending message to chat {message['chat_id']}: {e}")
+                return
+
+    async def _run_chat(self, chat_id):
+        """Deliver a chat's pending messages one at a time, until none are left."""
+        queue = self._chats[chat_id]
+        try:
+            while queue:
+                await self._deliver(queue[0])
+                queue.popleft()
+                self._pending.release()
+        finally:
+            del self._chats[chat_id]
+
+    async def stop(self):
+        """Deliver the messages still pending, then stop the chat workers."""
+        if not self._workers:
+            return
+        _, unfinished = await asyncio.wait(set(self._workers), timeout=self.DRAIN_TIMEOUT)
+        if unfinished:
+            undelivered = sum(len(queue) for queue in self._chats.values())
+            logger.warning(f"Dropping {undelivered} undelivered messages")
+            for worker in unfinished:
+                worker.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+# Update processing
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates handled at once across all chats; the Redis pool is sized to match
+    MAX_CONCURRENT_UPDATES = 64
+
+    def __init__(self):
+        """Initialize the update processor."""
+        super().__init__(self.MAX_CONCURRENT_UPDATES)
+        self._chat_locks = {}  # chat_id -> [lock, updates holding or waiting for it]
+
+    async def process_update(self, update, coroutine):
+        """Wait for every earlier update from the same chat, then process this one."""
+        # Conversation handlers rely on each chat's updates arriving one by one
+        if isinstance(update, Update) and update.effective_chat:
+            key = update.effective_chat.id
+        elif isinstance(update, Update) and update.effective_user:
+            key = update.effective_user.id
+        else:
+            await super().process_update(update, coroutine)
+            return
         
-        import random
-        return random.choice(responses), False
+        # Take the chat's lock before a processing slot, so updates queued
+        # behind a busy chat don't hold slots other chats could use
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        """Process an update that holds its chat's lock and a processing slot."""
+        await coroutine
+
+    async def initialize(self):
+        """Nothing to set up."""
+
+    async def shutdown(self):
+        """Nothing to clean up."""
 
-# Initialize database and LLM
+# Initialize database, LLM and message sender
 db = Database()
 llm = LLMIntegration()
+sender = MessageSender()
 
 # Conversation states
 (
@@ -256,27 +662,129 @@ llm = LLMIntegration()
     ACTIVITY_GROUP, ACTIVITY_TYPE, ACTIVITY_TITLE, ACTIVITY_DESC, ACTIVITY_DURATION
 ) = range(19)
 
-# Global variables
-group_message_timestamps = {}  # Track last AI intervention in groups
-private_chat_sessions = {}  # Track active support sessions
+# Help message for each role, built once
+HELP_COMMANDS = (
+    "🤖 *AutiConnect Bot - Comandos Disponíveis:*\n\n"
+    "/start - Iniciar ou reiniciar o bot\n"
+    "/ajuda - Mostrar esta mensagem de ajuda\n"
+    "/grupos - Ver grupos temáticos disponíveis\n"
+    "/atividades - Ver atividades programadas\n"
+    "/perfil - Atualizar seu perfil\n\n"
+)
+HELP_AT_COMMANDS = (
+    "*Comandos exclusivos para ATs:*\n"
+    "/criar_grupo - Criar um novo grupo temático\n"
+    "/iniciar_atividade - Iniciar uma nova atividade estruturada\n\n"
+)
+HELP_FOOTER = (
+    "O AutiConnect oferece mediadores de IA disponíveis 24/7 para facilitar interações "
+    "e oferecer suporte quando necessário. Os mediadores podem ajudar com:\n\n"
+    "• Facilitação de conversas em grupo\n"
+    "• Suporte individual em conversas privadas\n"
+    "• Estruturação de atividades\n"
+    "• Detecção de situações que requerem intervenção profissional\n\n"
+    "Para conversar com um mediador de IA em privado, basta enviar uma mensagem diretamente para este bot."
+)
+HELP_TEXT_BY_ROLE = {
+    'at': HELP_COMMANDS + HELP_AT_COMMANDS + HELP_FOOTER,
+    'autista': HELP_COMMANDS + HELP_FOOTER,
+}
+
+# Readable names for activity type codes
+ACTIVITY_TYPE_NAMES = {
+    'discussao': 'Discussão Temática',
+    'projeto': 'Projeto Colaborativo',
+    'jogo': 'Jogo Social',
+    'compartilhamento': 'Compartilhamento de Interesses'
+}
+
+# Whether the AI mediator/guide is enabled, as shown in listings
+AI_STATUS_LABELS = {True: "✅ Ativo", False: "❌ Inativo"}
+
+# Entries of the /grupos and /atividades listings
+GROUP_LISTING_TEMPLATE = (
+    "*{name}*\n"
+    "📝 Tema: {theme}\n"
+    "👥 Membros: {members_count}/{max_members}\n"
+    "👨‍⚕️ AT: {at_name}\n"
+    "🤖 Mediador IA: {ai_status}\n"
+    "ℹ️ {description}\n\n"
+)
+ACTIVITY_LISTING_TEMPLATE = (
+    "*{title}*\n"
+    "📝 Tipo: {type}\n"
+    "👥 Grupo: {group_name}\n"
+    "🕒 Quando: {scheduled_time}\n"
+    "⏱️ Duração: {duration} minutos\n"
+    "🤖 Guia IA: {ai_status}\n"
+    "ℹ️ {description}\n\n"
+)
+
+# Static keyboards, shared by every conversation
+ROLE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Pessoa Autista", callback_data='autista')],
+    [InlineKeyboardButton("Auxiliar Terapêutico (AT)", callback_data='at')]
+])
+GENDER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Masculino", callback_data='masculino')],
+    [InlineKeyboardButton("Feminino", callback_data='feminino')],
+    [InlineKeyboardButton("Não-binário", callback_data='nao-binario')],
+    [InlineKeyboardButton("Prefiro não informar", callback_data='nao-informado')]
+])
+COMMUNICATION_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Direta e objetiva", callback_data='direta')],
+    [InlineKeyboardButton("Detalhada e explicativa", callback_data='detalhada')]
+])
+ACTIVITY_TYPE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Discussão Temática", callback_data="type_discussao")],
+    [InlineKeyboardButton("Projeto Colaborativo", callback_data="type_projeto")],
+    [InlineKeyboardButton("Jogo Social", callback_data="type_jogo")],
+    [InlineKeyboardButton("Compartilhamento de Interesses", callback_data="type_compartilhamento")]
+])
+
+# Numeric replies (age, group size, duration)
+NUMBER_PATTERN = re.compile(r"\A\d+\Z")
+
+# Text replies that are not commands, shared by every conversation step
+TEXT_NOT_CMD = filters.TEXT & ~filters.COMMAND
+
+# Callback data prefixes
+GROUP_PATTERN = re.compile(r"^group_")
+TYPE_PATTERN = re.compile(r"^type_")
+JOIN_PATTERN = re.compile(r"^join_")
+
+def parse_number(text):
+    """
+    Parse a reply made only of digits, or return None if it is anything else.
+    """
+    match = NUMBER_PATTERN.match(text.strip())
+    return int(match.group(0)) if match else None
+
+def format_timestamp(timestamp_ns, fmt="%d/%m/%Y às %H:%M"):
+    """
+    Format a stored time.time_ns() timestamp for display.
+    """
+    return datetime.fromtimestamp(timestamp_ns / 1e9).strftime(fmt)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Start command handler. Initiates the registration process.
     """
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    await db.update_last_active(user_id)
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if user:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             f"Olá novamente, {user['name']}! Você já está registrado como {user['role']}.\n\n"
             f"Use /grupos para ver grupos disponíveis ou /atividades para ver atividades programadas."
         )
         return ConversationHandler.END
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Olá! Bem-vindo ao AutiConnect, um espaço seguro para interação entre pessoas autistas "
         "com mediação de IA disponível 24/7.\n\n"
         "Para começar, por favor me diga seu nome:"
@@ -289,14 +797,10 @@ async def process_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     """
     context.user_data['name'] = update.message.text
     
-    keyboard = [
-        [InlineKeyboardButton("Pessoa Autista", callback_data='autista')],
-        [InlineKeyboardButton("Auxiliar Terapêutico (AT)", callback_data='at')]
-    ]
-    
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         f"Obrigado, {context.user_data['name']}! Qual é o seu papel?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=ROLE_KEYBOARD
     )
     return REGISTER_ROLE
 
@@ -314,7 +818,7 @@ async def process_role(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     name = context.user_data['name']
     
     # Create user in database
-    success = db.create_user(user_id, name, role)
+    success = await db.create_user(user_id, name, role)
     
     if success:
         if role == 'autista':
@@ -343,33 +847,28 @@ async def process_profile_age(update: Update, context: ContextTypes.DEFAULT_TYPE
     """
     Process user's age input and ask for gender.
     """
-    try:
-        age = int(update.message.text)
-        if age < 5 or age > 100:
-            await update.message.reply_text(
-                "Por favor, digite uma idade válida entre 5 e 100 anos."
-            )
-            return PROFILE_AGE
-    except ValueError:
-        await update.message.reply_text(
+    age = parse_number(update.message.text)
+    if age is None:
+        await sender.reply(
+            update,
             "Por favor, digite apenas números para sua idade."
         )
         return PROFILE_AGE
+    if age < 5 or age > 100:
+        await sender.reply(
+            update,
+            "Por favor, digite uma idade válida entre 5 e 100 anos."
+        )
+        return PROFILE_AGE
     
     # Store in context for later database update
     context.user_data['profile_age'] = age
     
     # Ask for gender
-    keyboard = [
-        [InlineKeyboardButton("Masculino", callback_data='masculino')],
-        [InlineKeyboardButton("Feminino", callback_data='feminino')],
-        [InlineKeyboardButton("Não-binário", callback_data='nao-binario')],
-        [InlineKeyboardButton("Prefiro não informar", callback_data='nao-informado')]
-    ]
-    
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Obrigado! Qual é o seu gênero?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=GENDER_KEYBOARD
     )
     return PROFILE_GENDER
 
@@ -399,7 +898,8 @@ async def process_profile_contacts(update: Update, context: ContextTypes.DEFAULT
     contacts = [contact.strip() for contact in contacts_text.split('\n') if contact.strip()]
     context.user_data['profile_contacts'] = contacts
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Obrigado! Agora, conte-nos brevemente sobre seu histórico acadêmico.\n"
         "Por exemplo: escolas que frequentou, nível de escolaridade, etc."
     )
@@ -412,7 +912,8 @@ async def process_profile_academic(update: Update, context: ContextTypes.DEFAULT
     academic_history = update.message.text
     context.user_data['profile_academic'] = academic_history
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Obrigado! Agora, por favor, liste os profissionais com quem você já trabalhou "
         "ou trabalha atualmente (terapeutas, psicólogos, etc.).\n\n"
         "Digite no formato: Nome - Especialidade\n"
@@ -429,7 +930,8 @@ async def process_profile_professionals(update: Update, context: ContextTypes.DE
     professionals = [prof.strip() for prof in professionals_text.split('\n') if prof.strip()]
     context.user_data['profile_professionals'] = professionals
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Obrigado! Agora, conte-nos sobre seus interesses especiais, hobbies ou tópicos favoritos.\n"
         "Isso nos ajudará a sugerir grupos e atividades relevantes para você.\n\n"
         "Por favor, liste seus interesses separados por vírgulas."
@@ -444,7 +946,8 @@ async def process_profile_interests(update: Update, context: ContextTypes.DEFAUL
     interests = [interest.strip() for interest in interests_text.split(',') if interest.strip()]
     context.user_data['profile_interests'] = interests
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Obrigado! Para nos ajudar a criar um ambiente confortável, "
         "poderia nos informar sobre gatilhos conhecidos de ansiedade ou desconforto?\n\n"
         "Por exemplo: barulhos altos, interrupções frequentes, certos tópicos, etc.\n"
@@ -461,14 +964,10 @@ async def process_profile_triggers(update: Update, context: ContextTypes.DEFAULT
     context.user_data['profile_triggers'] = triggers
     
     # Ask for communication preferences
-    keyboard = [
-        [InlineKeyboardButton("Direta e objetiva", callback_data='direta')],
-        [InlineKeyboardButton("Detalhada e explicativa", callback_data='detalhada')]
-    ]
-    
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Quase terminando! Como você prefere que nos comuniquemos com você?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=COMMUNICATION_KEYBOARD
     )
     return PROFILE_COMMUNICATION
 
@@ -498,7 +997,7 @@ async def process_profile_communication(update: Update, context: ContextTypes.DE
         }
     }
     
-    success = db.update_user_profile(user_id, profile_data)
+    success = await db.update_user_profile(user_id, profile_data)
     
     if success:
         await query.edit_message_text(
@@ -524,101 +1023,94 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     Display help information.
     """
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    await db.update_last_active(user_id)
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Você precisa se registrar primeiro. Use /start para criar seu perfil."
         )
         return
     
-    help_text = (
-        "🤖 *AutiConnect Bot - Comandos Disponíveis:*\n\n"
-        "/start - Iniciar ou reiniciar o bot\n"
-        "/ajuda - Mostrar esta mensagem de ajuda\n"
-        "/grupos - Ver grupos temáticos disponíveis\n"
-        "/atividades - Ver atividades programadas\n"
-        "/perfil - Atualizar seu perfil\n\n"
-    )
+    help_text = HELP_TEXT_BY_ROLE.get(user.get('role'), HELP_TEXT_BY_ROLE['autista'])
     
-    if user.get('role') == 'at':
-        help_text += (
-            "*Comandos exclusivos para ATs:*\n"
-            "/criar_grupo - Criar um novo grupo temático\n"
-            "/iniciar_atividade - Iniciar uma nova atividade estruturada\n\n"
-        )
+    await sender.reply(update, help_text, parse_mode=ParseMode.MARKDOWN)
+
+async def build_group_listing(groups):
+    """
+    Render the /grupos message and its join buttons as (label, callback_data) pairs.
+    """
+    # AT names and joinable group IDs, one read each
+    at_names = await db.get_group_creator_names()
+    joinable = await db.get_joinable_group_ids()
     
-    help_text += (
-        "O AutiConnect oferece mediadores de IA disponíveis 24/7 para facilitar interações "
-        "e oferecer suporte quando necessário. Os mediadores podem ajudar com:\n\n"
-        "• Facilitação de conversas em grupo\n"
-        "• Suporte individual em conversas privadas\n"
-        "• Estruturação de atividades\n"
-        "• Detecção de situações que requerem intervenção profissional\n\n"
-        "Para conversar com um mediador de IA em privado, basta enviar uma mensagem diretamente para este bot."
-    )
+    parts = ["📋 *Grupos Disponíveis:*\n\n"]
+    buttons = []
     
-    await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+    for group in groups:
+        members_count = group['members_count']
+        max_members = group.get('max_members', 10)
+        
+        # Get AT name
+        at_name = at_names.get(str(group['group_id']), 'Desconhecido')
+        
+        parts.append(GROUP_LISTING_TEMPLATE.format_map({
+            'name': group['name'],
+            'theme': group['theme'],
+            'members_count': members_count,
+            'max_members': max_members,
+            'at_name': at_name,
+            'ai_status': AI_STATUS_LABELS[group.get('ai_mediator_enabled', False)],
+            'description': group['description'],
+        }))
+        
+        # Add join button
+        if str(group['group_id']) in joinable:
+            buttons.append((f"Entrar: {group['name']}", f"join_{group['group_id']}"))
+    
+    return "".join(parts), buttons
 
 async def list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     List all available thematic groups.
     """
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
-    
-    groups = db.get_all_groups()
-    
-    if not groups:
-        await update.message.reply_text(
-            "Não há grupos disponíveis no momento.\n\n"
-            "Se você é um AT, pode criar um novo grupo com /criar_grupo."
-        )
-        return
+    await db.update_last_active(user_id)
     
-    message = "📋 *Grupos Disponíveis:*\n\n"
+    cached = await db.get_cache(db.GROUPS_CACHE_KEY)
     
-    for group in groups:
-        members_count = len(group.get('members', []))
-        max_members = group.get('max_members', 10)
-        
-        # Get AT name
-        at_id = group.get('created_by')
-        at = db.get_user(at_id)
-        at_name = at.get('name', 'Desconhecido') if at else 'Desconhecido'
+    if cached:
+        message, buttons = cached
+    else:
+        groups = await db.get_all_groups()
         
-        # Check if AI mediator is enabled
-        ai_enabled = group.get('ai_mediator_enabled', False)
-        ai_status = "✅ Ativo" if ai_enabled else "❌ Inativo"
+        if not groups:
+            await sender.reply(
+                update,
+                "Não há grupos disponíveis no momento.\n\n"
+                "Se você é um AT, pode criar um novo grupo com /criar_grupo."
+            )
+            return
         
-        message += (
-            f"*{group['name']}*\n"
-            f"📝 Tema: {group['theme']}\n"
-            f"👥 Membros: {members_count}/{max_members}\n"
-            f"👨‍⚕️ AT: {at_name}\n"
-            f"🤖 Mediador IA: {ai_status}\n"
-            f"ℹ️ {group['description']}\n\n"
-        )
+        message, buttons = await build_group_listing(groups)
+        await db.set_cache(db.GROUPS_CACHE_KEY, [message, buttons])
     
-    # Add join button
-    keyboard = []
-    for group in groups:
-        if len(group.get('members', [])) < group.get('max_members', 10):
-            keyboard.append([InlineKeyboardButton(
-                f"Entrar: {group['name']}", 
-                callback_data=f"join_{group['group_id']}"
-            )])
+    keyboard = [
+        [InlineKeyboardButton(label, callback_data=callback_data)]
+        for label, callback_data in buttons
+    ]
     
     if keyboard:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             message, 
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     else:
-        await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+        await sender.reply(update, message, parse_mode=ParseMode.MARKDOWN)
 
 async def join_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -628,13 +1120,13 @@ async def join_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     user_id = update.effective_user.id
-    group_id = int(query.data.split('_')[1])
+    group_id = int(query.data[len('join_'):])
     
     # Add user to group
-    success = db.add_user_to_group(user_id, group_id)
+    success = await db.add_user_to_group(user_id, group_id)
     
     if success:
-        group = db.get_group(group_id)
+        group = await db.get_group(group_id)
         group_name = group.get('name', 'Grupo') if group else 'Grupo'
         
         await query.edit_message_text(
@@ -653,23 +1145,26 @@ async def create_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     Start the group creation process (AT only).
     """
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    await db.update_last_active(user_id)
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Você precisa se registrar primeiro. Use /start para criar seu perfil."
         )
         return ConversationHandler.END
     
     if user.get('role') != 'at':
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Desculpe, apenas Auxiliares Terapêuticos (ATs) podem criar grupos."
         )
         return ConversationHandler.END
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Vamos criar um novo grupo temático.\n\n"
         "Qual será o nome do grupo?"
     )
@@ -681,7 +1176,8 @@ async def process_group_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """
     context.user_data['group_name'] = update.message.text
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         f"Ótimo! O nome do grupo será: {context.user_data['group_name']}\n\n"
         f"Agora, qual será o tema principal deste grupo? (ex: videogames, música, ciência)"
     )
@@ -693,7 +1189,8 @@ async def process_group_theme(update: Update, context: ContextTypes.DEFAULT_TYPE
     """
     context.user_data['group_theme'] = update.message.text
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         f"Tema definido: {context.user_data['group_theme']}\n\n"
         f"Por favor, forneça uma breve descrição do propósito deste grupo:"
     )
@@ -705,7 +1202,8 @@ async def process_group_desc(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """
     context.user_data['group_desc'] = update.message.text
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         f"Descrição registrada. Qual será o número máximo de participantes? (recomendado: 8-12)"
     )
     return GROUP_MAX
@@ -714,29 +1212,30 @@ async def process_group_max(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """
     Process max members input and create the group.
     """
-    try:
-        max_members = int(update.message.text)
-        if max_members < 2 or max_members > 50:
-            await update.message.reply_text(
-                "Por favor, escolha um número entre 2 e 50. Qual será o número máximo de participantes?"
-            )
-            return GROUP_MAX
-    except ValueError:
-        await update.message.reply_text(
+    max_members = parse_number(update.message.text)
+    if max_members is None:
+        await sender.reply(
+            update,
             "Por favor, digite apenas números. Qual será o número máximo de participantes?"
         )
         return GROUP_MAX
+    if max_members < 2 or max_members > 50:
+        await sender.reply(
+            update,
+            "Por favor, escolha um número entre 2 e 50. Qual será o número máximo de participantes?"
+        )
+        return GROUP_MAX
     
     context.user_data['group_max'] = max_members
     
     # Create a temporary group ID (in a real implementation, this would be the actual Telegram group ID)
-    # For this MVP, we'll use a timestamp-based ID
-    group_id = int(datetime.now().timestamp())
+    # For this MVP, we'll use a sequential ID
+    group_id = await db.next_group_id()
     
     user_id = update.effective_user.id
     
     # Create group in database
-    success = db.create_group(
+    success = await db.create_group(
         group_id=group_id,
         name=context.user_data['group_name'],
         theme=context.user_data['group_theme'],
@@ -746,105 +1245,122 @@ async def process_group_max(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     
     if success:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             f"✅ Grupo '{context.user_data['group_name']}' criado com sucesso!\n\n"
             f"Em uma implementação completa, você receberia um link para convidar participantes. "
             f"Para este MVP, considere o grupo criado e pronto para uso.\n\n"
             f"Use /iniciar_atividade para começar uma atividade neste grupo."
         )
     else:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Desculpe, ocorreu um erro ao criar o grupo. Por favor, tente novamente."
         )
     
     return ConversationHandler.END
 
-async def list_activities(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def build_activity_listing(activities):
     """
-    List upcoming activities for the user's groups.
+    Render the /atividades message for a list of activities.
     """
-    user_id = update.effective_user.id
-    db.update_last_active(user_id)
-    
-    activities = db.get_user_activities(user_id)
-    
-    if not activities:
-        await update.message.reply_text(
-            "Não há atividades programadas para seus grupos no momento.\n\n"
-            "Se você é um AT, pode iniciar uma nova atividade com /iniciar_atividade."
-        )
-        return
+    # Fetch every group referenced by the activities in one round trip
+    groups = await db.get_groups({activity.get('group_id') for activity in activities})
     
-    message = "📅 *Atividades Programadas:*\n\n"
+    parts = ["📅 *Atividades Programadas:*\n\n"]
     
     for activity in activities:
         # Get group name
-        group_id = activity.get('group_id')
-        group = db.get_group(group_id)
+        group = groups.get(activity.get('group_id'))
         group_name = group.get('name', 'Desconhecido') if group else 'Desconhecido'
         
-        # Format scheduled time
-        scheduled_time = activity.get('scheduled_time', 'Não definido')
-        if scheduled_time != 'Não definido':
-            if isinstance(scheduled_time, datetime):
-                scheduled_time = scheduled_time.strftime("%d/%m/%Y às %H:%M")
+        # Scheduled time is formatted once, when the activity is created
+        scheduled_time = activity.get('scheduled_time_str')
+        if scheduled_time is None:
+            scheduled_time = activity.get('scheduled_time')
+            scheduled_time = format_timestamp(scheduled_time) if scheduled_time else 'Não definido'
+        
+        parts.append(ACTIVITY_LISTING_TEMPLATE.format_map({
+            'title': activity['title'],
+            'type': activity['type'],
+            'group_name': group_name,
+            'scheduled_time': scheduled_time,
+            'duration': activity.get('duration', 60),
+            'ai_status': AI_STATUS_LABELS[activity.get('ai_guidance_enabled', False)],
+            'description': activity['description'],
+        }))
+    
+    return "".join(parts)
+
+async def list_activities(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    List upcoming activities for the user's groups.
+    """
+    user_id = update.effective_user.id
+    await db.update_last_active(user_id)
+    
+    cache_key = db.ACTIVITIES_CACHE_KEY.format(user_id)
+    message = await db.get_cache(cache_key)
+    
+    if not message:
+        activities = await db.get_user_activities(user_id)
         
-        # Check if AI guidance is enabled
-        ai_enabled = activity.get('ai_guidance_enabled', False)
-        ai_status = "✅ Ativo" if ai_enabled else "❌ Inativo"
+        if not activities:
+            await sender.reply(
+                update,
+                "Não há atividades programadas para seus grupos no momento.\n\n"
+                "Se você é um AT, pode iniciar uma nova atividade com /iniciar_atividade."
+            )
+            return
         
-        message += (
-            f"*{activity['title']}*\n"
-            f"📝 Tipo: {activity['type']}\n"
-            f"👥 Grupo: {group_name}\n"
-            f"🕒 Quando: {scheduled_time}\n"
-            f"⏱️ Duração: {activity.get('duration', 60)} minutos\n"
-            f"🤖 Guia IA: {ai_status}\n"
-            f"ℹ️ {activity['description']}\n\n"
-        )
+        message = await build_activity_listing(activities)
+        await db.set_cache(cache_key, message)
     
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    await sender.reply(update, message, parse_mode=ParseMode.MARKDOWN)
 
 async def start_activity_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Start the activity creation process (AT only).
     """
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    await db.update_last_active(user_id)
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     if not user:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Você precisa se registrar primeiro. Use /start para criar seu perfil."
         )
         return ConversationHandler.END
     
     if user.get('role') != 'at':
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Desculpe, apenas Auxiliares Terapêuticos (ATs) podem iniciar atividades."
         )
         return ConversationHandler.END
     
     # Get groups where user is AT
-    groups = db.get_all_groups()
-    at_groups = [g for g in groups if g.get('created_by') == user_id]
+    at_groups = await db.get_groups_by_creator(user_id)
     
     if not at_groups:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Você não tem nenhum grupo como AT. Crie um grupo primeiro com /criar_grupo."
         )
         return ConversationHandler.END
     
-    # Store groups in context for later use
-    context.user_data['at_groups'] = at_groups
+    # Store groups in context for later use, keyed by group ID
+    context.user_data['at_groups'] = {group['group_id']: group for group in at_groups}
     
     # Create keyboard with group options
     keyboard = []
     for group in at_groups:
         keyboard.append([InlineKeyboardButton(group['name'], callback_data=f"group_{group['group_id']}")])
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         "Vamos iniciar uma nova atividade estruturada.\n\n"
         "Primeiro, selecione o grupo para esta atividade:",
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -859,25 +1375,20 @@ async def process_activity_group(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     
-    group_id = int(query.data.split('_')[1])
-    context.user_data['activity_group_id'] = group_id
+    group_id = int(query.data[len('group_'):])
+    # Collect the activity's fields across the conversation steps
+    context.user_data['activity'] = {'group_id': group_id}
     
     # Find group name
-    group_name = next((g['name'] for g in context.user_data['at_groups'] if g['group_id'] == group_id), "Grupo")
+    group = context.user_data['at_groups'].get(group_id)
+    group_name = group['name'] if group else "Grupo"
     context.user_data['activity_group_name'] = group_name
     
     # Activity type options
-    keyboard = [
-        [InlineKeyboardButton("Discussão Temática", callback_data="type_discussao")],
-        [InlineKeyboardButton("Projeto Colaborativo", callback_data="type_projeto")],
-        [InlineKeyboardButton("Jogo Social", callback_data="type_jogo")],
-        [InlineKeyboardButton("Compartilhamento de Interesses", callback_data="type_compartilhamento")]
-    ]
-    
     await query.edit_message_text(
         f"Grupo selecionado: {group_name}\n\n"
         f"Qual tipo de atividade você deseja iniciar?",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=ACTIVITY_TYPE_KEYBOARD
     )
     
     return ACTIVITY_TYPE
@@ -889,21 +1400,13 @@ async def process_activity_type(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     
-    activity_type = query.data.split('_')[1]
-    context.user_data['activity_type'] = activity_type
-    
-    # Map type codes to readable names
-    type_names = {
-        'discussao': 'Discussão Temática',
-        'projeto': 'Projeto Colaborativo',
-        'jogo': 'Jogo Social',
-        'compartilhamento': 'Compartilhamento de Interesses'
-    }
+    activity_type = query.data[len('type_'):]
+    context.user_data['activity']['activity_type'] = activity_type
     
-    context.user_data['activity_type_name'] = type_names.get(activity_type, activity_type)
+    activity_type_name = ACTIVITY_TYPE_NAMES.get(activity_type, activity_type)
     
     await query.edit_message_text(
-        f"Tipo de atividade: {context.user_data['activity_type_name']}\n\n"
+        f"Tipo de atividade: {activity_type_name}\n\n"
         f"Qual será o título desta atividade?"
     )
     
@@ -913,10 +1416,12 @@ async def process_activity_title(update: Update, context: ContextTypes.DEFAULT_T
     """
     Process activity title input and ask for description.
     """
-    context.user_data['activity_title'] = update.message.text
+    title = update.message.text
+    context.user_data['activity']['title'] = title
     
-    await update.message.reply_text(
-        f"Título: {context.user_data['activity_title']}\n\n"
+    await sender.reply(
+        update,
+        f"Título: {title}\n\n"
         f"Por favor, forneça uma breve descrição desta atividade:"
     )
     
@@ -926,9 +1431,10 @@ async def process_activity_desc(update: Update, context: ContextTypes.DEFAULT_TY
     """
     Process activity description input and ask for duration.
     """
-    context.user_data['activity_desc'] = update.message.text
+    context.user_data['activity']['description'] = update.message.text
     
-    await update.message.reply_text(
+    await sender.reply(
+        update,
         f"Descrição registrada. Qual será a duração desta atividade em minutos? (ex: 30, 60)"
     )
     
@@ -938,43 +1444,40 @@ async def process_activity_duration(update: Update, context: ContextTypes.DEFAUL
     """
     Process activity duration input and create the activity.
     """
-    try:
-        duration = int(update.message.text)
-        if duration < 5 or duration > 180:
-            await update.message.reply_text(
-                "Por favor, escolha uma duração entre 5 e 180 minutos."
-            )
-            return ACTIVITY_DURATION
-    except ValueError:
-        await update.message.reply_text(
+    duration = parse_number(update.message.text)
+    if duration is None:
+        await sender.reply(
+            update,
             "Por favor, digite apenas números para a duração em minutos."
         )
         return ACTIVITY_DURATION
+    if duration < 5 or duration > 180:
+        await sender.reply(
+            update,
+            "Por favor, escolha uma duração entre 5 e 180 minutos."
+        )
+        return ACTIVITY_DURATION
     
-    context.user_data['activity_duration'] = duration
+    activity = context.user_data['activity']
+    activity['duration'] = duration
     
     user_id = update.effective_user.id
     
     # Create activity in database
-    activity_id = db.create_activity(
-        group_id=context.user_data['activity_group_id'],
-        activity_type=context.user_data['activity_type'],
-        title=context.user_data['activity_title'],
-        description=context.user_data['activity_desc'],
-        created_by=user_id,
-        duration=context.user_data['activity_duration']
-    )
+    activity_id = await db.create_activity(created_by=user_id, **activity)
     
     if activity_id:
-        await update.message.reply_text(
-            f"✅ Atividade '{context.user_data['activity_title']}' criada com sucesso para o grupo "
+        await sender.reply(
+            update,
+            f"✅ Atividade '{activity['title']}' criada com sucesso para o grupo "
             f"'{context.user_data['activity_group_name']}'!\n\n"
             f"Em uma implementação completa, todos os membros do grupo seriam notificados. "
             f"Para este MVP, considere a atividade criada e pronta para começar.\n\n"
             f"Use /atividades para ver todas as atividades programadas."
         )
     else:
-        await update.message.reply_text(
+        await sender.reply(
+            update,
             "Desculpe, ocorreu um erro ao criar a atividade. Por favor, tente novamente."
         )
     
@@ -989,11 +1492,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     text = message.text
     
     # Get user from database
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     
     # If user doesn't exist, suggest registration
     if not user:
-        await message.reply_text(
+        await sender.reply(
+            update,
             "Olá! Parece que você ainda não está registrado. Use /start para criar seu perfil."
         )
         return
@@ -1001,10 +1505,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Check if this is a private chat or group chat
     if message.chat.type == 'private':
         # Generate AI support response
-        ai_response, alert_needed = llm.provide_individual_support(user_id, text)
+        ai_response, alert_needed = await llm.provide_individual_support_async(user_id, text)
         
         if ai_response:
-            await message.reply_text(
+            await sender.reply(
+                update,
                 f"🤖 *Assistente IA*: {ai_response}",
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1013,30 +1518,50 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # In this MVP, we'll just acknowledge the message
         pass
 
-def main() -> None:
-    """Start the bot."""
-    # Get the token from environment variable
-    token = os.environ.get('BOT_TOKEN')
-    if not token:
-        logger.error("BOT_TOKEN environment variable not set")
-        return
-    
-    # Create the Application
-    application = Application.builder().token(token).build()
+async def post_init(application: Application) -> None:
+    """Start background tasks once the application is initialized."""
+    application.bot_data['last_active_flusher'] = asyncio.create_task(db.run_last_active_flusher())
+    sender.start(application.bot)
+
+async def post_stop(application: Application) -> None:
+    """Deliver pending messages while the bot can still send them."""
+    await sender.stop()
+
+async def post_shutdown(application: Application) -> None:
+    """Stop background tasks, persist any buffered state and close connections."""
+    flusher = application.bot_data.pop('last_active_flusher', None)
+    if flusher:
+        flusher.cancel()
+        # Let an interrupted flush hand its timestamps back before the final one
+        await asyncio.gather(flusher, return_exceptions=True)
+    await db.close()
+    llm.close()
+
+def build_application(token) -> Application:
+    """Create the Application and register all handlers."""
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(ChatUpdateProcessor())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Add conversation handler for registration and profile creation
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            REGISTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_name)],
+            REGISTER_NAME: [MessageHandler(TEXT_NOT_CMD, process_name)],
             REGISTER_ROLE: [CallbackQueryHandler(process_role)],
-            PROFILE_AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_profile_age)],
+            PROFILE_AGE: [MessageHandler(TEXT_NOT_CMD, process_profile_age)],
             PROFILE_GENDER: [CallbackQueryHandler(process_profile_gender)],
-            PROFILE_CONTACTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_profile_contacts)],
-            PROFILE_ACADEMIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_profile_academic)],
-            PROFILE_PROFESSIONALS: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_profile_professionals)],
-            PROFILE_INTERESTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_profile_interests)],
-            PROFILE_TRIGGERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_profile_triggers)],
+            PROFILE_CONTACTS: [MessageHandler(TEXT_NOT_CMD, process_profile_contacts)],
+            PROFILE_ACADEMIC: [MessageHandler(TEXT_NOT_CMD, process_profile_academic)],
+            PROFILE_PROFESSIONALS: [MessageHandler(TEXT_NOT_CMD, process_profile_professionals)],
+            PROFILE_INTERESTS: [MessageHandler(TEXT_NOT_CMD, process_profile_interests)],
+            PROFILE_TRIGGERS: [MessageHandler(TEXT_NOT_CMD, process_profile_triggers)],
             PROFILE_COMMUNICATION: [CallbackQueryHandler(process_profile_communication)],
         },
         fallbacks=[CommandHandler('start', start)],
@@ -1047,10 +1572,10 @@ def main() -> None:
     group_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('criar_grupo', create_group_start)],
         states={
-            GROUP_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_group_name)],
-            GROUP_THEME: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_group_theme)],
-            GROUP_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_group_desc)],
-            GROUP_MAX: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_group_max)],
+            GROUP_NAME: [MessageHandler(TEXT_NOT_CMD, process_group_name)],
+            GROUP_THEME: [MessageHandler(TEXT_NOT_CMD, process_group_theme)],
+            GROUP_DESC: [MessageHandler(TEXT_NOT_CMD, process_group_desc)],
+            GROUP_MAX: [MessageHandler(TEXT_NOT_CMD, process_group_max)],
         },
         fallbacks=[CommandHandler('start', start)],
     )
@@ -1060,11 +1585,11 @@ def main() -> None:
     activity_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('iniciar_atividade', start_activity_command)],
         states={
-            ACTIVITY_GROUP: [CallbackQueryHandler(process_activity_group, pattern=r'^group_')],
-            ACTIVITY_TYPE: [CallbackQueryHandler(process_activity_type, pattern=r'^type_')],
-            ACTIVITY_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_activity_title)],
-            ACTIVITY_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_activity_desc)],
-            ACTIVITY_DURATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_activity_duration)],
+            ACTIVITY_GROUP: [CallbackQueryHandler(process_activity_group, pattern=GROUP_PATTERN)],
+            ACTIVITY_TYPE: [CallbackQueryHandler(process_activity_type, pattern=TYPE_PATTERN)],
+            ACTIVITY_TITLE: [MessageHandler(TEXT_NOT_CMD, process_activity_title)],
+            ACTIVITY_DESC: [MessageHandler(TEXT_NOT_CMD, process_activity_desc)],
+            ACTIVITY_DURATION: [MessageHandler(TEXT_NOT_CMD, process_activity_duration)],
         },
         fallbacks=[CommandHandler('start', start)],
     )
@@ -1076,13 +1601,33 @@ def main() -> None:
     application.add_handler(CommandHandler('atividades', list_activities))
     
     # Add callback query handlers
-    application.add_handler(CallbackQueryHandler(join_group_callback, pattern=r'^join_'))
+    application.add_handler(CallbackQueryHandler(join_group_callback, pattern=JOIN_PATTERN))
     
     # Add message handler
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(TEXT_NOT_CMD, handle_message))
     
-    # Start the Bot
-    application.run_polling()
+    return application
+
+def main() -> None:
+    """Start the bot."""
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN environment variable not set")
+        return
+    
+    application = build_application(BOT_TOKEN)
+    
+    # Start the Bot: receive updates through a webhook when one is configured,
+    # otherwise fall back to long polling
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path="telegram",
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/telegram",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()